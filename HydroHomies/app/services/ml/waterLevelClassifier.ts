@@ -58,6 +58,13 @@ const MODEL_INPUT_SIZE = 224 // Match training configuration
 const CLASSES: WaterLevel[] = ["half", "full", "overflowing"] // Actual model classes
 const NUM_CLASSES = CLASSES.length
 
+// Pixel range the model expects. Newer exports normalize inside the model and record
+// "input_range": [0, 255] in model_metadata.json; older exports expect [0, 1].
+const modelMetadata: {
+  input_range?: [number, number]
+} = require("../../../assets/models/water-level-classifier/model_metadata.json")
+const MODEL_INPUT_MAX = modelMetadata.input_range?.[1] ?? 1
+
 // Model instance (loaded once, reused for all predictions)
 let model: tf.LayersModel | null = null
 let isModelLoading = false
@@ -335,8 +342,8 @@ async function preprocessImageNative(imageUri: string): Promise<tf.Tensor4D> {
       processedTensor = decodedTensor as tf.Tensor3D
     }
 
-    // Normalize pixel values from [0, 255] to [0, 1]
-    const normalized = processedTensor.div(255.0)
+    // Scale pixel values to the range the model expects
+    const normalized = normalizePixels(processedTensor)
 
     // Ensure the shape is [1, 224, 224, 3] (batch, height, width, channels)
     const batched = normalized.expandDims(0) as tf.Tensor4D
@@ -352,6 +359,13 @@ async function preprocessImageNative(imageUri: string): Promise<tf.Tensor4D> {
   }
 }
 
+/**
+ * Scale [0, 255] pixel values to the model's input range
+ */
+function normalizePixels(image: tf.Tensor3D): tf.Tensor3D {
+  return MODEL_INPUT_MAX === 255 ? tf.cast(image, "float32") : image.div(255.0)
+}
+
 /**
  * Preprocess image on web platform using tf.browser.fromPixels
  */
@@ -386,8 +400,8 @@ async function preprocessImageWeb(imageUri: string, base64Data?: string): Promis
     // Convert canvas pixels to tensor
     const imageTensor = tf.browser.fromPixels(canvas, 3)
 
-    // Normalize pixel values from [0, 255] to [0, 1]
-    const normalized = imageTensor.div(255.0)
+    // Scale pixel values to the range the model expects
+    const normalized = normalizePixels(imageTensor)
 
     // Ensure the shape is [1, 224, 224, 3]
     const batched = normalized.expandDims(0) as tf.Tensor4D
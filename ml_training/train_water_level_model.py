@@ -13,19 +13,22 @@ Requirements:
 - tensorflowjs>=4.10.0
 - kagglehub
 - numpy
-- Pillow
 - scikit-learn
 
 Install dependencies:
-pip install tensorflow tensorflowjs kagglehub numpy pillow scikit-learn
+pip install tensorflow tensorflowjs kagglehub numpy scikit-learn
 """
 
 import os
+import sys
 import json
+import importlib.util
+import hashlib
+import ssl
 import shutil
+import tempfile
 from pathlib import Path
 import numpy as np
-from PIL import Image
 import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras import layers
@@ -34,11 +37,21 @@ import kagglehub
 
 # Model configuration
 IMG_SIZE = 224  # Standard input size for mobile models
-BATCH_SIZE = 32
+BATCH_SIZE = 32  # Per replica; scaled by the number of GPUs in main()
 EPOCHS = 50
-LEARNING_RATE = 0.001
+LEARNING_RATE = 0.001  # Per replica; scaled linearly with the global batch size
+SHUFFLE_BUFFER_SIZE = 2048
+RESUME = True  # Warm-start from models/best_model.keras if it exists (FORCE_RETRAIN=1 overrides)
+QUANTIZE = "uint8"  # Weight quantization for the TensorFlow.js export: "uint8", "float16" or None
+AUTOTUNE = tf.data.AUTOTUNE
 MODEL_OUTPUT_DIR = Path(__file__).parent / "models"
 TENSORFLOWJS_OUTPUT_DIR = Path(__file__).parent / "models" / "tensorflowjs_model"
+BEST_MODEL_PATH = MODEL_OUTPUT_DIR / "best_model.keras"
+# Written once the frozen-backbone stage has finished, so RESUME never fine-tunes
+# a checkpoint saved partway through that stage
+HEAD_STAGE_MARKER_PATH = MODEL_OUTPUT_DIR / "best_model.head_complete"
+SNAPSHOT_DIR = MODEL_OUTPUT_DIR / "snapshots"  # Decoded datasets saved between runs
+PREPROCESSING_VERSION = 3  # Bump when decoding/resizing changes so snapshots are rebuilt
 
 # Water level classes
 # Note: The Kaggle dataset has: "Full Water level", "Half water level", "Overflowing"
@@ -57,6 +70,98 @@ FOLDER_NAME_MAPPING = {
     "overflowing": "overflowing",
     # Note: "empty" and "low" are not in the dataset - we'll skip them or use existing classes
 }
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+
+
+def check_dependencies():
+    """
+    Fail fast if a package that is only imported late in the pipeline is missing
+    
+    Packages imported at the top of this script already fail on startup; this
+    covers the ones that would otherwise only fail after training (e.g. export).
+    """
+    required = ["tensorflowjs"]
+    missing = [module for module in required if importlib.util.find_spec(module) is None]
+    if missing:
+        sys.exit(f"❌ Missing dependencies. Install them with: pip install {' '.join(missing)}")
+
+
+def enable_mixed_precision():
+    """Use mixed_float16 when a GPU with Tensor Cores (compute capability >= 7.0) is available"""
+    for gpu in tf.config.list_physical_devices("GPU"):
+        details = tf.config.experimental.get_device_details(gpu)
+        if details.get("compute_capability", (0, 0)) >= (7, 0):
+            keras.mixed_precision.set_global_policy("mixed_float16")
+            print(f"⚡ Mixed precision enabled ({details.get('device_name', gpu.name)})")
+            return True
+    return False
+
+
+MIXED_PRECISION = enable_mixed_precision()
+
+
+def configure_https():
+    """
+    Make HTTPS downloads (e.g. pre-trained ImageNet weights) verify against certifi's CA bundle
+    
+    Certificate verification is only disabled when KERAS_INSECURE_DOWNLOAD=1 is
+    set, as a last-resort workaround for broken local certificate setups.
+    """
+    if os.environ.get("KERAS_INSECURE_DOWNLOAD") == "1":
+        print("⚠️  KERAS_INSECURE_DOWNLOAD=1: HTTPS certificate verification is disabled")
+        ssl._create_default_https_context = ssl._create_unverified_context
+        return
+    
+    try:
+        import certifi
+    except ImportError:
+        return
+    os.environ.setdefault("SSL_CERT_FILE", certifi.where())
+
+
+configure_https()
+
+
+def create_optimizer(learning_rate):
+    """Create an Adam optimizer, wrapped for dynamic loss scaling under mixed precision"""
+    optimizer = keras.optimizers.Adam(learning_rate=learning_rate)
+    if MIXED_PRECISION:
+        optimizer = keras.mixed_precision.LossScaleOptimizer(optimizer)
+    return optimizer
+
+
+def create_strategy():
+    """
+    Pick a distribution strategy for the available hardware
+    
+    Uses MultiWorkerMirroredStrategy with NCCL all-reduce when TF_CONFIG
+    describes a multi-node cluster, otherwise MirroredStrategy over all local
+    GPUs (which falls back to a single CPU/GPU replica).
+    """
+    if "TF_CONFIG" in os.environ:
+        communication_options = tf.distribute.experimental.CommunicationOptions(
+            implementation=tf.distribute.experimental.CommunicationImplementation.NCCL,
+        )
+        return tf.distribute.MultiWorkerMirroredStrategy(communication_options=communication_options)
+    return tf.distribute.MirroredStrategy()
+
+
+def is_chief(strategy):
+    """Whether this process writes shared artifacts; always true outside multi-worker training"""
+    resolver = strategy.cluster_resolver
+    if resolver is None or resolver.task_type is None:
+        return True
+    cluster = resolver.cluster_spec().as_dict()
+    return resolver.task_type == "chief" or (
+        resolver.task_type == "worker" and resolver.task_id == 0 and "chief" not in cluster
+    )
+
+
+def wait_for_workers(strategy):
+    """Block until every worker reaches this point; a no-op outside multi-worker training"""
+    if isinstance(strategy, tf.distribute.MultiWorkerMirroredStrategy):
+        # A collective all-reduce only completes once all workers have joined it
+        strategy.reduce(tf.distribute.ReduceOp.SUM, strategy.run(lambda: tf.constant(1)), axis=None)
 
 
 def download_dataset():
@@ -75,9 +180,13 @@ def download_dataset():
         raise
 
 
-def load_and_preprocess_data(dataset_path: Path):
+def list_image_paths(dataset_path: Path):
     """
-    Load and preprocess images from the dataset
+    Collect image paths and labels from the dataset
+    
+    Returns (paths, labels) as arrays of file paths and class indices. Images
+    are only decoded later in the tf.data pipeline (see build_dataset), so the
+    train/validation split happens before any pixel data exists in memory.
     
     The actual dataset structure has nested folders:
     dataset/
@@ -92,9 +201,9 @@ def load_and_preprocess_data(dataset_path: Path):
         └── "Overflowing"/
             └── ...
     """
-    print("📂 Loading and preprocessing images...")
+    print("📂 Collecting image paths...")
     
-    images = []
+    paths = []
     labels = []
     label_to_index = {cls: idx for idx, cls in enumerate(CLASSES)}
     
@@ -118,121 +227,276 @@ def load_and_preprocess_data(dataset_path: Path):
             
         label_idx = label_to_index[class_name]
         
-        # Handle nested directory structure: class_dir/class_dir/images
-        # First, check if images are directly in class_dir
-        image_files = list(class_dir.glob("*.jpg")) + list(class_dir.glob("*.png")) + list(class_dir.glob("*.jpeg"))
-        
-        # If no images found, check nested subdirectories
-        if not image_files:
-            subdirs = [d for d in class_dir.iterdir() if d.is_dir()]
-            for subdir in subdirs:
-                image_files.extend(list(subdir.glob("*.jpg")))
-                image_files.extend(list(subdir.glob("*.png")))
-                image_files.extend(list(subdir.glob("*.jpeg")))
-                
-                # Also check recursively in case of deeper nesting
-                image_files.extend(list(subdir.rglob("*.jpg")))
-                image_files.extend(list(subdir.rglob("*.png")))
-                image_files.extend(list(subdir.rglob("*.jpeg")))
+        # Handle nested directory structure (class_dir/class_dir/images) with a
+        # single walk of the class directory, so each image is listed exactly once
+        image_files = sorted(
+            p for p in class_dir.rglob("*") if p.suffix.lower() in IMAGE_EXTENSIONS and p.is_file()
+        )
         
         if not image_files:
             print(f"⚠️  No images found in {class_dir}")
             continue
             
-        print(f"  Loading {len(image_files)} images from '{class_name}' class (folder: {class_dir.name})...")
+        print(f"  Found {len(image_files)} images for '{class_name}' class (folder: {class_dir.name})")
         
-        for img_path in image_files:
-            try:
-                # Load and preprocess image
-                img = Image.open(img_path).convert("RGB")
-                img = img.resize((IMG_SIZE, IMG_SIZE))
-                img_array = np.array(img, dtype=np.float32) / 255.0  # Normalize to [0, 1]
-                
-                images.append(img_array)
-                labels.append(label_idx)
-            except Exception as e:
-                print(f"⚠️  Error loading image {img_path}: {e}")
-                continue
+        paths.extend(str(img_path) for img_path in image_files)
+        labels.extend([label_idx] * len(image_files))
     
-    if not images:
-        raise ValueError("No images were loaded! Please check the dataset structure.")
+    if not paths:
+        raise ValueError("No images were found! Please check the dataset structure.")
     
-    print(f"✅ Loaded {len(images)} images across {len(set(labels))} classes")
+    print(f"✅ Found {len(paths)} images across {len(set(labels))} classes")
     
-    # Convert to numpy arrays
-    X = np.array(images)
-    y = np.array(labels)
+    return np.array(paths), np.array(labels)
+
+
+def decode_image(contents):
+    """
+    Decode an encoded image to a uint8 RGB tensor
     
-    # Convert labels to categorical (one-hot encoding)
-    y_categorical = keras.utils.to_categorical(y, num_classes=NUM_CLASSES)
+    JPEGs are decoded at the largest libjpeg DCT scale factor (1/2, 1/4 or 1/8)
+    that keeps the shorter side at least 2 * IMG_SIZE, so multi-megapixel photos
+    are never fully decoded just to be resized down to IMG_SIZE. Other formats
+    (e.g. PNG) are decoded at full resolution.
+    """
+    def decode_jpeg():
+        short_side = tf.reduce_min(tf.io.extract_jpeg_shape(contents)[:2])
+        scale_index = tf.add_n([
+            tf.cast(short_side >= 2 * IMG_SIZE * ratio, tf.int32) for ratio in (2, 4, 8)
+        ])
+        return tf.switch_case(scale_index, [
+            lambda ratio=ratio: tf.io.decode_jpeg(contents, channels=3, ratio=ratio)
+            for ratio in (1, 2, 4, 8)
+        ])
+    
+    def decode_other():
+        return tf.io.decode_image(contents, channels=3, expand_animations=False)
+    
+    return tf.cond(tf.io.is_jpeg(contents), decode_jpeg, decode_other)
+
+
+def load_image(path):
+    """Read a single image file and resize it to IMG_SIZE as uint8"""
+    img = decode_image(tf.io.read_file(path))
+    # Antialias: images are still shrunk 2-4x after DCT scaling (PNGs much more),
+    # and the app's ImageManipulator/canvas resizes filter as well
+    img = tf.image.resize(img, [IMG_SIZE, IMG_SIZE], method="bilinear", antialias=True)
+    img = tf.ensure_shape(img, [IMG_SIZE, IMG_SIZE, 3])
+    return tf.cast(img, tf.uint8)  # Keep uint8 so snapshots stay small
+
+
+def get_versioned_path(directory: Path, split: str, paths, labels) -> Path:
+    """
+    Return the path of a per-split artifact (e.g. a snapshot directory)
     
-    return X, y_categorical, y
+    The name includes a hash of the image paths, their labels, the class list,
+    the input size and PREPROCESSING_VERSION, so any change to the dataset or
+    label schema gets a fresh artifact.
+    """
+    digest = hashlib.sha1(f"{PREPROCESSING_VERSION}:{IMG_SIZE}:{','.join(CLASSES)}".encode())
+    for path, label in zip(paths, labels):
+        digest.update(f"{path}\0{label}\n".encode())
+    return directory / f"{split}_{digest.hexdigest()[:12]}"
 
 
-def create_model():
-    """Create a MobileNetV2-based model optimized for mobile devices"""
-    print("🏗️  Creating model architecture...")
+def compute_class_weights(labels):
+    """Weight each class inversely to its frequency so all classes contribute equally to the loss"""
+    counts = np.bincount(labels, minlength=NUM_CLASSES)
+    return {
+        idx: float(counts.sum() / (NUM_CLASSES * max(count, 1)))
+        for idx, count in enumerate(counts)
+    }
+
+
+def create_data_augmentation():
+    """Random transforms on [0, 255] pixels; only active while training"""
+    return keras.Sequential([
+        layers.RandomFlip("horizontal"),
+        layers.RandomRotation(0.1),
+        layers.RandomZoom(0.1),
+        layers.RandomBrightness(0.1),
+    ], name="data_augmentation")
+
+
+def save_snapshot(paths, labels, snapshot_dir: Path):
+    """
+    Decode and resize a split's images once and save them with tf.data's Dataset.save
+    
+    Later runs load the snapshot directly and skip reading and decoding the
+    full-size photos. It is written to a temporary directory and moved into
+    place when complete, so an interrupted run never leaves a partial snapshot.
+    Each element keeps its source path so unreadable images can be reported.
+    """
+    print(f"💾 Decoding {len(paths)} images into a dataset snapshot...")
+    ds = tf.data.Dataset.from_tensor_slices((paths, labels))
+    # Decode on all cores; order doesn't matter since training shuffles, so
+    # don't let one large image hold up the images decoded after it
+    ds = ds.map(
+        lambda path, label: (load_image(path), label, path),
+        num_parallel_calls=AUTOTUNE,
+        deterministic=False,
+    )
+    ds = ds.ignore_errors()  # Skip unreadable images instead of failing the run
+    
+    tmp_dir = snapshot_dir.with_name(snapshot_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    ds.save(str(tmp_dir), compression="GZIP")
+    
+    saved = tf.data.Dataset.load(str(tmp_dir), compression="GZIP")
+    saved_paths = {path.decode() for _, _, path in saved.as_numpy_iterator()}
+    skipped = [path for path in paths if str(path) not in saved_paths]
+    for path in skipped:
+        print(f"⚠️  Error loading image {path}, skipping")
+    
+    if not saved_paths:
+        shutil.rmtree(tmp_dir)
+        raise ValueError("No images could be decoded! Please check the dataset files.")
     
-    # Disable SSL verification for downloading weights (if needed)
-    # This is a workaround for SSL certificate issues
-    import ssl
-    ssl._create_default_https_context = ssl._create_unverified_context
+    tmp_dir.rename(snapshot_dir)
+    print(f"✅ Saved {len(saved_paths)} images ({len(skipped)} skipped)")
+
+
+def prepare_snapshot(split: str, paths, labels):
+    """
+    Make sure a split's snapshot exists, removing snapshots built from other inputs
     
+    Only the chief should call this in multi-worker training, so workers sharing
+    MODEL_OUTPUT_DIR don't delete or rename each other's files.
+    """
+    snapshot_dir = get_versioned_path(SNAPSHOT_DIR, split, paths, labels)
+    SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+    for stale in SNAPSHOT_DIR.glob(f"{split}_*"):
+        if stale.name.startswith(snapshot_dir.name):
+            continue
+        if stale.is_dir():
+            shutil.rmtree(stale)
+        else:
+            stale.unlink()
+    
+    if not snapshot_dir.exists():
+        save_snapshot(paths, labels, snapshot_dir)
+
+
+def build_dataset(paths, labels, training: bool, batch_size: int = BATCH_SIZE):
+    """Build a tf.data pipeline over a split's snapshot (see prepare_snapshot)"""
+    split = "train" if training else "val"
+    snapshot_dir = get_versioned_path(SNAPSHOT_DIR, split, paths, labels)
+    ds = tf.data.Dataset.load(str(snapshot_dir), compression="GZIP")
+    ds = ds.map(
+        lambda img, label, path: (img, tf.one_hot(label, NUM_CLASSES)),
+        num_parallel_calls=AUTOTUNE,
+    )
+    ds = ds.cache()  # Decompress the snapshot once, not every epoch
+    if training:
+        ds = ds.shuffle(SHUFFLE_BUFFER_SIZE)
+    ds = ds.batch(batch_size)
+    
+    # Shard by element across workers: a snapshot has too few files to shard by file
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
+    return ds.with_options(options).prefetch(AUTOTUNE)
+
+
+def create_base_model(weights="imagenet"):
+    """Create the MobileNetV2 backbone, falling back to random init if the weights can't be loaded"""
     try:
-        # Use MobileNetV2 as base (pre-trained on ImageNet)
-        base_model = keras.applications.MobileNetV2(
+        return keras.applications.MobileNetV2(
             input_shape=(IMG_SIZE, IMG_SIZE, 3),
             include_top=False,
-            weights="imagenet",
+            weights=weights,
             alpha=0.35,  # Width multiplier (smaller = faster, less accurate)
         )
     except Exception as e:
+        if weights is None:
+            raise
         print(f"⚠️  Error loading pre-trained weights: {e}")
         print("💡 Loading model without pre-trained weights (will train from scratch)...")
-        # Load without pre-trained weights if download fails
-        base_model = keras.applications.MobileNetV2(
-            input_shape=(IMG_SIZE, IMG_SIZE, 3),
-            include_top=False,
-            weights=None,  # Train from scratch
-            alpha=0.35,
-        )
+        return create_base_model(weights=None)
+
+
+def build_model(include_augmentation: bool = True, weights="imagenet"):
+    """Build the (uncompiled) classifier under the current dtype policy"""
+    base_model = create_base_model(weights)
     
     # Freeze base model layers initially
     base_model.trainable = False
     
     # Add custom classification head
+    # Inputs are raw [0, 255] pixels (uint8 batches are cast on the device).
+    # Augmentation runs on the device as part of the training step and is a
+    # no-op at inference; then rescale to the [-1, 1] range MobileNetV2's
+    # ImageNet weights were trained on
     inputs = keras.Input(shape=(IMG_SIZE, IMG_SIZE, 3))
-    x = base_model(inputs, training=False)
+    x = inputs
+    if include_augmentation:
+        x = create_data_augmentation()(x)
+    x = layers.Rescaling(scale=1.0 / 127.5, offset=-1)(x)
+    # training=False keeps the backbone's BatchNormalization layers in inference
+    # mode, even after the backbone is unfrozen for fine-tuning
+    x = base_model(x, training=False)
     x = layers.GlobalAveragePooling2D()(x)
     x = layers.Dropout(0.2)(x)
     x = layers.Dense(128, activation="relu")(x)
     x = layers.Dropout(0.2)(x)
-    outputs = layers.Dense(NUM_CLASSES, activation="softmax")(x)
+    # Keep the softmax in float32 so the loss stays numerically stable under mixed precision
+    outputs = layers.Dense(NUM_CLASSES, activation="softmax", dtype="float32")(x)
     
-    model = keras.Model(inputs, outputs)
+    return keras.Model(inputs, outputs)
+
+
+def create_model(learning_rate: float = LEARNING_RATE):
+    """Create a MobileNetV2-based model optimized for mobile devices"""
+    print("🏗️  Creating model architecture...")
+    model = build_model()
     
     # Compile model
     model.compile(
-        optimizer=keras.optimizers.Adam(learning_rate=LEARNING_RATE),
+        optimizer=create_optimizer(learning_rate),
         loss="categorical_crossentropy",
         metrics=["accuracy"],
+        # XLA can't compile the projective transforms behind RandomRotation/RandomZoom
+        jit_compile=False,
     )
     
     print(f"✅ Model created: {model.count_params()} parameters")
     return model
 
 
-def train_model(model, X_train, y_train, X_val, y_val):
-    """Train the model with data augmentation"""
-    print("🚀 Starting training...")
+def get_base_model(model):
+    """Return the MobileNetV2 backbone nested inside the classifier"""
+    return next(layer for layer in model.layers if layer.name.startswith("mobilenetv2"))
+
+
+def has_input_rescaling(model):
+    """Check that a saved model normalizes raw [0, 255] pixels itself, as the current pipeline expects"""
+    return any(isinstance(layer, layers.Rescaling) for layer in model.layers)
+
+
+def train_model(
+    model,
+    train_ds,
+    val_ds,
+    strategy,
+    learning_rate: float = LEARNING_RATE,
+    class_weight=None,
+    resume: bool = False,
+):
+    """
+    Train the model on the augmented training dataset
     
-    # Data augmentation
-    data_augmentation = keras.Sequential([
-        layers.RandomFlip("horizontal"),
-        layers.RandomRotation(0.1),
-        layers.RandomZoom(0.1),
-        layers.RandomBrightness(0.1),
-    ])
+    With resume=True the model is a checkpoint from a previous run: the frozen-
+    backbone stage is skipped and only fine-tuning runs, and the checkpoint is
+    only overwritten by a model that beats its current validation accuracy.
+    """
+    best_val_accuracy = None
+    if resume:
+        _, best_val_accuracy = model.evaluate(val_ds, verbose=0)
+        print(f"♻️  Resumed model validation accuracy: {best_val_accuracy:.4f}")
+    
+    # Only the chief writes the shared checkpoint; other workers still have to
+    # take part in saving, so they write to a private temporary directory
+    chief = is_chief(strategy)
+    checkpoint_path = BEST_MODEL_PATH if chief else Path(tempfile.mkdtemp()) / BEST_MODEL_PATH.name
     
     # Callbacks
     callbacks = [
@@ -248,85 +512,115 @@ def train_model(model, X_train, y_train, X_val, y_val):
             min_lr=1e-7,
         ),
         keras.callbacks.ModelCheckpoint(
-            str(MODEL_OUTPUT_DIR / "best_model.keras"),
+            str(checkpoint_path),
             monitor="val_accuracy",
             save_best_only=True,
+            initial_value_threshold=best_val_accuracy,
         ),
     ]
     
-    # Create training dataset with augmentation
-    def augmented_generator(X, y):
-        while True:
-            indices = np.random.permutation(len(X))
-            for i in range(0, len(X), BATCH_SIZE):
-                batch_indices = indices[i:i+BATCH_SIZE]
-                X_batch = X[batch_indices]
-                y_batch = y[batch_indices]
-                
-                # Apply augmentation
-                X_batch = data_augmentation(X_batch, training=True)
-                yield X_batch, y_batch
-    
     # Train model
-    train_gen = augmented_generator(X_train, y_train)
-    steps_per_epoch = len(X_train) // BATCH_SIZE
-    
-    history = model.fit(
-        train_gen,
-        steps_per_epoch=steps_per_epoch,
-        epochs=EPOCHS,
-        validation_data=(X_val, y_val),
-        callbacks=callbacks,
-        verbose=1,
-    )
+    history = None
+    if not resume:
+        print("🚀 Starting training...")
+        if chief and HEAD_STAGE_MARKER_PATH.exists():
+            HEAD_STAGE_MARKER_PATH.unlink()  # The checkpoint is about to be overwritten
+        history = model.fit(
+            train_ds,
+            epochs=EPOCHS,
+            validation_data=val_ds,
+            class_weight=class_weight,
+            callbacks=callbacks,
+            verbose=1,
+        )
+        if chief:
+            HEAD_STAGE_MARKER_PATH.touch()
     
     # Fine-tuning: Unfreeze some layers and retrain with lower learning rate
     print("🔧 Fine-tuning model...")
-    base_model = model.layers[1]  # MobileNetV2 layer
+    base_model = get_base_model(model)
     base_model.trainable = True
     
     # Freeze bottom layers, unfreeze top layers
     for layer in base_model.layers[:-30]:
         layer.trainable = False
     
-    model.compile(
-        optimizer=keras.optimizers.Adam(learning_rate=LEARNING_RATE / 10),
-        loss="categorical_crossentropy",
-        metrics=["accuracy"],
-    )
+    # Keep BatchNormalization frozen too. BN already runs in inference mode
+    # (training=False in build_model), so this only stops its gamma/beta from
+    # being fitted to the small domain-specific dataset
+    for layer in base_model.layers:
+        if isinstance(layer, layers.BatchNormalization):
+            layer.trainable = False
+    
+    # Optimizer variables must be created under the same strategy as the model
+    with strategy.scope():
+        model.compile(
+            optimizer=create_optimizer(learning_rate / 10),
+            loss="categorical_crossentropy",
+            metrics=["accuracy"],
+            jit_compile=False,
+        )
     
     history_finetune = model.fit(
-        train_gen,
-        steps_per_epoch=steps_per_epoch,
+        train_ds,
         epochs=EPOCHS // 2,  # Fewer epochs for fine-tuning
-        validation_data=(X_val, y_val),
+        validation_data=val_ds,
+        class_weight=class_weight,
         callbacks=callbacks,
         verbose=1,
     )
     
+    if not chief:
+        shutil.rmtree(checkpoint_path.parent, ignore_errors=True)
+    
     print("✅ Training completed!")
     return history, history_finetune
 
 
+def build_export_model(model):
+    """
+    Rebuild the trained classifier in float32 and without its data augmentation block
+    
+    Under mixed precision every layer's config records mixed_float16, which
+    TensorFlow.js can't compute in, and the random augmentation layers do
+    nothing at inference and aren't supported by TensorFlow.js either. The
+    trained weights are copied layer by layer into a fresh float32 model.
+    """
+    previous_policy = keras.mixed_precision.global_policy()
+    keras.mixed_precision.set_global_policy("float32")
+    try:
+        export_model = build_model(include_augmentation=False, weights=None)
+    finally:
+        keras.mixed_precision.set_global_policy(previous_policy)
+    
+    trained_layers = [layer for layer in model.layers if layer.name != "data_augmentation"]
+    for export_layer, trained_layer in zip(export_model.layers, trained_layers):
+        export_layer.set_weights(trained_layer.get_weights())
+    return export_model
+
+
 def convert_to_tensorflowjs(model, output_dir: Path):
     """Convert Keras model to TensorFlow.js format with compatibility settings"""
     print("🔄 Converting model to TensorFlow.js format...")
     
-    try:
-        import tensorflowjs as tfjs
-    except ImportError:
-        print("❌ tensorflowjs not installed. Installing...")
-        os.system("pip install tensorflowjs")
-        import tensorflowjs as tfjs
+    import tensorflowjs as tfjs  # Presence checked up front by check_dependencies()
     
     output_dir.mkdir(parents=True, exist_ok=True)
+    model = build_export_model(model)
+    
+    # Quantize all weights; TensorFlow.js dequantizes them back to float32 when loading
+    quantization_dtype_map = {QUANTIZE: "*"} if QUANTIZE else None
     
     # Convert using save_keras_model (direct conversion)
     # This should work better with newer TensorFlow.js versions
     # If this fails, we can try SavedModel approach
     try:
         print("   Converting model directly to TensorFlow.js format...")
-        tfjs.converters.save_keras_model(model, str(output_dir))
+        tfjs.converters.save_keras_model(
+            model,
+            str(output_dir),
+            quantization_dtype_map=quantization_dtype_map,
+        )
         print("   ✅ Direct conversion successful")
     except Exception as e:
         print(f"   ⚠️  Direct conversion failed: {e}")
@@ -346,7 +640,7 @@ def convert_to_tensorflowjs(model, output_dir: Path):
             tfjs.converters.convert_tf_saved_model(
                 str(savedmodel_dir),
                 str(output_dir),
-                quantization_dtype=None,
+                quantization_dtype_map=quantization_dtype_map,
             )
             
             print("   ✅ SavedModel conversion successful")
@@ -371,6 +665,8 @@ def convert_to_tensorflowjs(model, output_dir: Path):
         "classes": CLASSES,
         "num_classes": NUM_CLASSES,
         "model_type": "MobileNetV2",
+        "input_range": [0, 255],  # The model normalizes pixel values itself
+        "weight_quantization": QUANTIZE,
     }
     
     metadata_path = output_dir / "model_metadata.json"
@@ -392,40 +688,86 @@ def main():
     print("💧 Water Bottle Level Classification Model Training")
     print("=" * 60)
     
+    check_dependencies()
+    
     # Create output directories
     MODEL_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
     
     # Step 1: Download dataset
     dataset_path = download_dataset()
     
-    # Step 2: Load and preprocess data
-    X, y_categorical, y = load_and_preprocess_data(dataset_path)
+    # Step 2: Collect image paths and labels
+    paths, labels = list_image_paths(dataset_path)
     
-    # Step 3: Split data
+    # Step 3: Split data at the file-path level, before anything is decoded
     print("📊 Splitting data into train/validation sets...")
-    X_train, X_val, y_train, y_val = train_test_split(
-        X, y_categorical, test_size=0.2, random_state=42, stratify=y
+    train_paths, val_paths, train_labels, val_labels = train_test_split(
+        paths, labels, test_size=0.2, random_state=42, stratify=labels
     )
-    print(f"   Training samples: {len(X_train)}")
-    print(f"   Validation samples: {len(X_val)}")
-    
-    # Step 4: Create model
-    model = create_model()
+    print(f"   Training samples: {len(train_paths)}")
+    print(f"   Validation samples: {len(val_paths)}")
+    
+    class_weight = compute_class_weights(train_labels)
+    print("   Class weights: " + ", ".join(f"{CLASSES[idx]}={weight:.3f}" for idx, weight in class_weight.items()))
+    
+    # Scale the global batch size and learning rate with the number of replicas
+    strategy = create_strategy()
+    num_replicas = strategy.num_replicas_in_sync
+    batch_size = BATCH_SIZE * num_replicas
+    learning_rate = LEARNING_RATE * num_replicas
+    print(f"🖥️  Training on {num_replicas} replica(s): batch size {batch_size}, learning rate {learning_rate}")
+    
+    # Only the chief builds snapshots; other workers read them from the shared
+    # MODEL_OUTPUT_DIR once the chief is done
+    chief = is_chief(strategy)
+    if chief:
+        prepare_snapshot("train", train_paths, train_labels)
+        prepare_snapshot("val", val_paths, val_labels)
+    wait_for_workers(strategy)
+    
+    # model.fit distributes tf.data datasets across replicas automatically
+    train_ds = build_dataset(train_paths, train_labels, training=True, batch_size=batch_size)
+    val_ds = build_dataset(val_paths, val_labels, training=False, batch_size=batch_size)
+    
+    # Step 4: Create model, or warm-start from the best checkpoint of a previous run
+    model = None
+    if RESUME and BEST_MODEL_PATH.exists() and not os.environ.get("FORCE_RETRAIN"):
+        if not HEAD_STAGE_MARKER_PATH.exists():
+            print("⚠️  Checkpoint is from an unfinished initial training stage, rerunning that stage")
+        else:
+            with strategy.scope():
+                model = keras.models.load_model(BEST_MODEL_PATH)
+            if has_input_rescaling(model):
+                print(f"♻️  Resuming from {BEST_MODEL_PATH} (set FORCE_RETRAIN=1 to train from scratch)")
+            else:
+                print("⚠️  Checkpoint expects pre-normalized inputs, training from scratch instead")
+                model = None
+    
+    resume = model is not None
+    if not resume:
+        with strategy.scope():
+            model = create_model(learning_rate)
     
     # Step 5: Train model
-    history, history_finetune = train_model(model, X_train, y_train, X_val, y_val)
+    history, history_finetune = train_model(
+        model, train_ds, val_ds, strategy, learning_rate, class_weight=class_weight, resume=resume
+    )
+    
+    # Evaluation and export write shared files, so they only run on the chief
+    if not chief:
+        print("✅ Worker finished training; the chief evaluates and exports the model")
+        return
     
     # Step 6: Load best model
-    best_model_path = MODEL_OUTPUT_DIR / "best_model.keras"
-    if best_model_path.exists():
-        print(f"📥 Loading best model from {best_model_path}")
-        model = keras.models.load_model(best_model_path)
+    if BEST_MODEL_PATH.exists():
+        print(f"📥 Loading best model from {BEST_MODEL_PATH}")
+        model = keras.models.load_model(BEST_MODEL_PATH)
     else:
         print("⚠️  Best model checkpoint not found, using current model")
     
     # Step 7: Evaluate final model
     print("📊 Evaluating final model...")
-    val_loss, val_accuracy = model.evaluate(X_val, y_val, verbose=0)
+    val_loss, val_accuracy = model.evaluate(val_ds, verbose=0)
     print(f"   Validation Accuracy: {val_accuracy:.4f} ({val_accuracy*100:.2f}%)")
     print(f"   Validation Loss: {val_loss:.4f}")
     